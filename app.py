@@ -1,12 +1,28 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import sqlite3, os
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, abort
+import sqlite3, os, threading, json
+from collections import namedtuple
 from werkzeug.security import generate_password_hash, check_password_hash
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(APP_DIR, "data")
 USERS_DB = os.path.join(DATA_DIR, "users.db")
 
+# ---------- SQL ----------
+# queries run on requests; prepared statements are cached per connection (see _open and _pooled)
+SQL_INSERT_USER = "INSERT INTO users (company_name, email, password_hash, db_path) VALUES (?,?,?,?)"
+SQL_SET_USER_DB = "UPDATE users SET db_path=? WHERE id=?"
+SQL_GET_USER = "SELECT * FROM users WHERE email = ?"
+SQL_GET_CAMPOS = "SELECT id, nombre, tipo FROM campos ORDER BY id"
+SQL_INSERT_CAMPO = "INSERT INTO campos (nombre, tipo) VALUES (?, ?)"
+SQL_DELETE_CAMPO = "DELETE FROM campos WHERE id = ?"
+SQL_REMOVE_CAMPO_VALORES = "UPDATE registros SET valores_json = json_remove(valores_json, ?) WHERE valores_json IS NOT NULL"
+SQL_GET_REGISTROS = "SELECT id, creado_at, valores_json FROM registros ORDER BY id DESC LIMIT ? OFFSET ?"
+SQL_GET_VALORES = "SELECT valores_json FROM registros WHERE id=?"
+SQL_INSERT_REGISTRO = "INSERT INTO registros (valores_json) VALUES (?)"
+SQL_UPDATE_VALORES = "UPDATE registros SET valores_json = ? WHERE id = ?"
+SQL_DELETE_REGISTRO = "DELETE FROM registros WHERE id = ?"
+
 app = Flask(__name__)
 app.secret_key = "CAMBIA_ESTA_CLAVE_POR_OTRA_MUY_SECRETA"
 
@@ -15,15 +31,53 @@ def ensure_data_dir():
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
 
-def get_users_conn():
-    ensure_data_dir()
-    conn = sqlite3.connect(USERS_DB)
-    conn.row_factory = sqlite3.Row
+def _open(path):
+    conn = sqlite3.connect(path, cached_statements=256)
+    # WAL: readers don't block on writers (the mode is saved in the file)
+    if path != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+# connections stay open between requests, one per thread and db file.
+# This only pays off where threads are reused (the Procfile's gunicorn worker);
+# app.run() starts a new thread per request, so there every request opens a
+# fresh connection with an empty statement cache.
+_pool = threading.local()
+
+def _pooled(path):
+    conns = getattr(_pool, "conns", None)
+    if conns is None:
+        conns = _pool.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = _open(path)
+        conn.row_factory = sqlite3.Row
+        conns[path] = conn
     return conn
 
+def get_users_conn():
+    if "users_conn" not in g:
+        ensure_data_dir()
+        g.users_conn = _pooled(USERS_DB)
+    return g.users_conn
+
+@app.teardown_appcontext
+def release_conns(exc):
+    for name in ("users_conn", "company_conn"):
+        conn = g.pop(name, None)
+        if conn is None:
+            continue
+        if exc is None:
+            conn.commit()
+        else:
+            conn.rollback()
+
 def init_users_db():
     ensure_data_dir()
-    conn = get_users_conn()
+    conn = _open(USERS_DB)
     c = conn.cursor()
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -37,8 +91,36 @@ def init_users_db():
     conn.commit()
     conn.close()
 
+# company dbs already migrated by this process
+_migrated = set()
+_migrated_lock = threading.Lock()
+
+def migrate_company_db(conn):
+    # valores used to live in their own table, one row per campo; they are
+    # now a JSON object {campo_id: valor} in registros.valores_json
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(registros)")]
+        if "valores_json" not in cols:
+            conn.execute("ALTER TABLE registros ADD COLUMN valores_json TEXT")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='valores'").fetchone():
+            conn.execute("""
+                UPDATE registros SET valores_json = (
+                    SELECT json_group_object(v.campo_id, v.valor)
+                    FROM valores v WHERE v.registro_id = registros.id
+                )
+                WHERE valores_json IS NULL
+            """)
+            conn.execute("DROP TABLE valores")
+    try:
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_campos_nombre ON campos(nombre)")
+    except sqlite3.IntegrityError as e:
+        # older dbs may already have repeated campo names
+        print("No se pudo crear idx_campos_nombre:", e)
+    conn.commit()
+
 def init_company_db(db_path):
-    conn = sqlite3.connect(db_path)
+    conn = _open(db_path)
     c = conn.cursor()
     c.execute("""
     CREATE TABLE IF NOT EXISTS campos (
@@ -50,30 +132,38 @@ def init_company_db(db_path):
     c.execute("""
     CREATE TABLE IF NOT EXISTS registros (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        creado_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS valores (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        registro_id INTEGER NOT NULL,
-        campo_id INTEGER NOT NULL,
-        valor TEXT,
-        FOREIGN KEY(registro_id) REFERENCES registros(id),
-        FOREIGN KEY(campo_id) REFERENCES campos(id)
+        creado_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        valores_json TEXT
     )
     """)
+    migrate_company_db(conn)
+    with _migrated_lock:
+        _migrated.add(db_path)
     # default fields
     defaults = [("descripcion","text"), ("comprador","text"), ("costo","number")]
     for n,t in defaults:
         c.execute("INSERT OR IGNORE INTO campos (nombre,tipo) VALUES (?,?)", (n,t))
     conn.commit()
     conn.close()
+    invalidate_campos(db_path)
 
 # init users DB at startup
 init_users_db()
 
 # ---------- Auth ----------
+from functools import wraps
+def login_required(f):
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        if "user_id" not in session:
+            flash("Inicia sesión primero", "warning")
+            return redirect(url_for("login"))
+        return f(*args, **kwargs)
+    return wrapped
+
+# checked against when the email is unknown, so that case takes as long as a wrong password
+_DUMMY_HASH = generate_password_hash("dummy-password", method="scrypt")
+
 @app.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
@@ -86,18 +176,17 @@ def register():
         conn = get_users_conn()
         cur = conn.cursor()
         try:
-            cur.execute("INSERT INTO users (company_name, email, password_hash, db_path) VALUES (?,?,?,?)",
-                        (company, email, generate_password_hash(password), ""))
+            cur.execute(SQL_INSERT_USER,
+                        (company, email, generate_password_hash(password, method="scrypt"), ""))
             uid = cur.lastrowid
             db_path = os.path.join(DATA_DIR, f"company_{uid}.db")
-            cur.execute("UPDATE users SET db_path=? WHERE id=?", (db_path, uid))
+            cur.execute(SQL_SET_USER_DB, (db_path, uid))
             conn.commit()
-            conn.close()
             init_company_db(db_path)
             flash("Cuenta creada. Inicia sesión.", "success")
             return redirect(url_for("login"))
         except sqlite3.IntegrityError:
-            conn.close()
+            conn.rollback()
             flash("El correo ya está registrado.", "danger")
             return redirect(url_for("register"))
     return render_template("register.html")
@@ -109,10 +198,11 @@ def login():
         password = request.form.get("password","").strip()
         conn = get_users_conn()
         cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE email = ?", (email,))
+        cur.execute(SQL_GET_USER, (email,))
         user = cur.fetchone()
-        conn.close()
-        if user and check_password_hash(user["password_hash"], password):
+        if user is None:
+            check_password_hash(_DUMMY_HASH, password)
+        elif check_password_hash(user["password_hash"], password):
             session["user_id"] = user["id"]
             session["company_name"] = user["company_name"]
             session["company_db"] = user["db_path"]
@@ -137,77 +227,83 @@ def company_conn():
     if not os.path.exists(db):
         print(f"Error: archivo de base de datos no encontrado en {db}")
         return None
-    conn = sqlite3.connect(db)
-    conn.row_factory = sqlite3.Row
-    return conn
+    if "company_conn" not in g:
+        conn = _pooled(db)
+        with _migrated_lock:
+            if db not in _migrated:
+                migrate_company_db(conn)
+                _migrated.add(db)
+        g.company_conn = conn
+    return g.company_conn
 
-@app.route("/campos/add", methods=["POST"])
-@login_required
-def campos_add():
-    nombre = request.form.get("nombre","").strip()
-    tipo = request.form.get("tipo","text").strip()
-    
-    if nombre == "":
-        flash("Nombre requerido", "danger")
-        return redirect(url_for("manage"))
+# campos only change through /campos/*, so keep them in memory per company db
+_campos_cache = {}
+_campos_lock = threading.Lock()
 
+def get_campos():
     conn = company_conn()
     if not conn:
-        flash("Base de datos no disponible", "danger")
-        return redirect(url_for("manage"))
+        return []
+    db = session["company_db"]
+    # the query runs under the lock too, so an invalidate_campos() can't land
+    # between reading and storing and be overwritten by an older list
+    with _campos_lock:
+        campos = _campos_cache.get(db)
+        if campos is None:
+            campos = _campos_cache[db] = conn.execute(SQL_GET_CAMPOS).fetchall()
+    return campos
 
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO campos (nombre, tipo) VALUES (?, ?)", (nombre, tipo))
-        conn.commit()
-        flash(f"Campo '{nombre}' agregado", "success")
-    except sqlite3.IntegrityError:
-        flash("El campo ya existe", "warning")
-    except Exception as e:
-        flash(f"Error interno al agregar campo: {e}", "danger")
-        print("Error al agregar campo:", e)
-    finally:
-        conn.close()
+def invalidate_campos(db_path):
+    with _campos_lock:
+        _campos_cache.pop(db_path, None)
 
-    return redirect(url_for("manage"))
+def load_valores(valores_json):
+    return json.loads(valores_json or "{}")
+
+def dump_valores(campos):
+    return json.dumps({str(campo['id']): val for campo in campos
+                       if (val := request.form.get(f"field_{campo['id']}"))})
+
+REGISTROS_POR_PAGINA = 100
 
-def get_registros():
+Registro = namedtuple("Registro", "id creado_at valores")
+
+def get_page():
+    page = max(request.args.get("page", 1, type=int), 1)
+    # the OFFSET has to fit in a SQLite INTEGER
+    if (page - 1) * REGISTROS_POR_PAGINA > 2**63 - 1:
+        abort(404)
+    return page
+
+def get_registros(page=1):
     conn = company_conn()
     if not conn:
-        return []
-    reg_cur = conn.execute("SELECT id, creado_at FROM registros ORDER BY id DESC")
+        return [], False
+    nombres = {str(c["id"]): c["nombre"] for c in get_campos()}
+    # one extra row tells us if there is a next page
+    cur = conn.execute(SQL_GET_REGISTROS, (REGISTROS_POR_PAGINA + 1, (page - 1) * REGISTROS_POR_PAGINA))
+    rows = cur.fetchall()
+    hay_siguiente = len(rows) > REGISTROS_POR_PAGINA
     registros = []
-    for r in reg_cur.fetchall():
-        registro = {"id": r["id"], "creado_at": r["creado_at"], "valores": {}}
-        vcur = conn.execute("""
-            SELECT c.nombre, v.valor
-            FROM valores v
-            JOIN campos c ON c.id = v.campo_id
-            WHERE v.registro_id = ?
-        """, (r["id"],))
-        for v in vcur.fetchall():
-            registro["valores"][v["nombre"]] = v["valor"]
-        registros.append(registro)
-    conn.close()
-    return registros
+    for rid, creado_at, valores_json in rows[:REGISTROS_POR_PAGINA]:
+        valores = load_valores(valores_json)
+        registros.append(Registro(rid, creado_at, {nombres[k]: v for k, v in valores.items() if k in nombres}))
+    return registros, hay_siguiente
 
-# ---------- Protected pages ----------
-from functools import wraps
-def login_required(f):
-    @wraps(f)
-    def wrapped(*args, **kwargs):
-        if "user_id" not in session:
-            flash("Inicia sesión primero", "warning")
-            return redirect(url_for("login"))
-        return f(*args, **kwargs)
-    return wrapped
+# editar renders this directly after saving (a reload just saves the same values
+# again); agregar and campos/add redirect since repeating them is not harmless
+def render_registros(endpoint):
+    campos = get_campos()
+    page = get_page()
+    registros, hay_siguiente = get_registros(page)
+    return render_template(f"{endpoint}.html", campos=campos, registros=registros,
+                           endpoint=endpoint, page=page, hay_siguiente=hay_siguiente)
 
+# ---------- Protected pages ----------
 @app.route("/")
 @login_required
 def index():
-    campos = get_campos()
-    registros = get_registros()
-    return render_template("index.html", campos=campos, registros=registros)
+    return render_registros("index")
 
 @app.route("/agregar", methods=["GET","POST"])
 @login_required
@@ -216,18 +312,9 @@ def agregar():
         campos = get_campos()
         return render_template("agregar.html", campos=campos)
     conn = company_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO registros DEFAULT VALUES")
-    registro_id = cur.lastrowid
     campos = get_campos()
-    for campo in campos:
-        key = f"field_{campo['id']}"
-        val = request.form.get(key)
-        if val is not None and val != "":
-            cur.execute("INSERT INTO valores (registro_id, campo_id, valor) VALUES (?,?,?)",
-                        (registro_id, campo['id'], val))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(SQL_INSERT_REGISTRO, (dump_valores(campos),))
     flash("Registro agregado", "success")
     return redirect(url_for("index"))
 
@@ -240,30 +327,20 @@ def editar(id):
         return redirect(url_for("index"))
     if request.method == "GET":
         campos = get_campos()
-        vals = {v["campo_id"]: v["valor"] for v in conn.execute("SELECT campo_id,valor FROM valores WHERE registro_id=?", (id,)).fetchall()}
-        conn.close()
+        row = conn.execute(SQL_GET_VALORES, (id,)).fetchone()
+        vals = {int(k): v for k, v in load_valores(row["valores_json"]).items()} if row else {}
         return render_template("editar.html", campos=campos, registro_id=id, valores=vals)
     # POST update
-    cur = conn.cursor()
-    cur.execute("DELETE FROM valores WHERE registro_id = ?", (id,))
     campos = get_campos()
-    for campo in campos:
-        key = f"field_{campo['id']}"
-        val = request.form.get(key)
-        if val is not None and val != "":
-            cur.execute("INSERT INTO valores (registro_id, campo_id, valor) VALUES (?,?,?)",
-                        (id, campo['id'], val))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(SQL_UPDATE_VALORES, (dump_valores(campos), id))
     flash("Registro actualizado", "success")
-    return redirect(url_for("index"))
+    return render_registros("index")
 
 @app.route("/manage", methods=["GET"])
 @login_required
 def manage():
-    campos = get_campos()
-    registros = get_registros()
-    return render_template("manage.html", campos=campos, registros=registros)
+    return render_registros("manage")
 
 @app.route("/campos/add", methods=["POST"])
 @login_required
@@ -276,11 +353,12 @@ def campos_add():
     conn = company_conn()
     cur = conn.cursor()
     try:
-        cur.execute("INSERT INTO campos (nombre, tipo) VALUES (?, ?)", (nombre, tipo))
+        cur.execute(SQL_INSERT_CAMPO, (nombre, tipo))
         conn.commit()
+        invalidate_campos(session["company_db"])
+        flash(f"Campo '{nombre}' agregado", "success")
     except sqlite3.IntegrityError:
         flash("El campo ya existe", "warning")
-    conn.close()
     return redirect(url_for("manage"))
 
 @app.route("/campos/delete/<int:id>", methods=["POST"])
@@ -288,10 +366,10 @@ def campos_add():
 def campos_delete(id):
     conn = company_conn()
     cur = conn.cursor()
-    cur.execute("DELETE FROM valores WHERE campo_id = ?", (id,))
-    cur.execute("DELETE FROM campos WHERE id = ?", (id,))
+    cur.execute(SQL_REMOVE_CAMPO_VALORES, (f'$."{id}"',))
+    cur.execute(SQL_DELETE_CAMPO, (id,))
     conn.commit()
-    conn.close()
+    invalidate_campos(session["company_db"])
     flash("Campo eliminado", "info")
     return redirect(url_for("manage"))
 
@@ -300,10 +378,8 @@ def campos_delete(id):
 def registros_delete(id):
     conn = company_conn()
     cur = conn.cursor()
-    cur.execute("DELETE FROM valores WHERE registro_id = ?", (id,))
-    cur.execute("DELETE FROM registros WHERE id = ?", (id,))
+    cur.execute(SQL_DELETE_REGISTRO, (id,))
     conn.commit()
-    conn.close()
     flash("Registro eliminado", "info")
     return redirect(url_for("manage"))
 
@@ -1,28 +1,29 @@
 import sqlite3
 
-connection = sqlite3.connect('base_de_datos.db')
-cursor = connection.cursor()
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS usuarios (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nombre TEXT NOT NULL,
-    correo TEXT UNIQUE NOT NULL,
-    contraseña TEXT NOT NULL
-)
-''')
+def init_db(path='base_de_datos.db'):
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS registros (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nombre TEXT NOT NULL,
-    descripcion TEXT,
-    fecha TEXT
-)
-''')
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        correo TEXT UNIQUE NOT NULL,
+        contraseña TEXT NOT NULL
+    );
 
-connection.commit()
-connection.close()
+    CREATE TABLE IF NOT EXISTS registros (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        descripcion TEXT,
+        fecha TEXT
+    );
+    ''')
+    connection.close()
 
-print("Base de datos inicializada correctamente.")
 
+if __name__ == "__main__":
+    init_db()
+    print("Base de datos inicializada correctamente.")